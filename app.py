@@ -1,16 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
 import os
 import folium
 from streamlit_folium import st_folium
-import json
-import re
+import orjson
 import sys
-from typing import Any, Dict, List, Optional
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
 
 # --- Configuration & Constants ---
 DB_FILE = "data.db"
+# Columnar copy of the temperatures table, written next to the DB on every update.
+PARQUET_FILE = os.path.splitext(DB_FILE)[0] + ".parquet"
 JSON_SOURCE = "data.json"
 
 # Approximate coordinates for the locations in the database.
@@ -25,102 +28,206 @@ LOCATION_COORDS = {
     "高雄": {"lat": 22.627, "lon": 120.301},
     "恆春": {"lat": 22.004, "lon": 120.744},
 }
+# Struct-of-arrays view of LOCATION_COORDS: name -> row index into parallel lat/lon arrays.
+_NAMES = tuple(LOCATION_COORDS)
+_LATS = np.fromiter((LOCATION_COORDS[n]["lat"] for n in _NAMES), dtype=np.float32, count=len(_NAMES))
+_LONS = np.fromiter((LOCATION_COORDS[n]["lon"] for n in _NAMES), dtype=np.float32, count=len(_NAMES))
+_IDX = {n: i for i, n in enumerate(_NAMES)}
+# Marker data is precomputed once; the folium objects themselves are rebuilt every run because
+# st_folium rewrites element ids in place, so a reused Map renders broken JavaScript.
+_MARKERS = [(name, c["lat"], c["lon"]) for name, c in LOCATION_COORDS.items()]
 
 # --- Data Fetching & Processing Logic (from fetch_temperatures.py) ---
+_TEMP_TOKENS = ("temp", "溫度")
+_LOC_KEYS = tuple(sys.intern(k) for k in ("locationName", "stationName", "siteName", "location", "locationname", "name"))
 
 def is_temp_name(name: str) -> bool:
     """Checks if an element name looks like a temperature."""
-    return bool(re.search(r"temp|temperature|t\b|溫度", name, re.IGNORECASE))
+    n = name.lower()
+    # A word ending in "t" covers CWA forecast names such as T, AT, MaxT and MinT (the old t\b case).
+    return any(t in n for t in _TEMP_TOKENS) or any(w.endswith("t") for w in n.split())
 
 def find_locations(data: Any) -> List[Dict[str, Optional[str]]]:
     """
-    Recursively scan JSON to find objects that represent locations with temperatures.
+    Scan JSON with an explicit stack to find objects that represent locations with temperatures.
     """
     found: List[Dict[str, Optional[str]]] = []
-    def scan(obj: Any, inherited_loc_name: Optional[str] = None):
+    stack = deque([(data, None)])
+    while stack:
+        obj, loc_name = stack.pop()
         if isinstance(obj, dict):
-            loc_name = inherited_loc_name
-            for k in ("locationName", "locationname", "location", "siteName", "stationName", "name"):
-                if k in obj and isinstance(obj[k], str):
-                    loc_name = obj[k]; break
-            if "weatherElement" in obj and isinstance(obj["weatherElement"], list):
-                for elem in obj["weatherElement"]:
-                    if not isinstance(elem, dict): continue
-                    elem_name = elem.get("elementName") or elem.get("name") or ""
-                    if is_temp_name(elem_name):
-                        temp_val = None
-                        val_container = elem.get("elementValue") or elem.get("value")
-                        if isinstance(val_container, dict):
-                            temp_val = val_container.get("value") or val_container.get("measure")
-                        elif val_container is not None:
-                            temp_val = str(val_container)
-                        if loc_name and temp_val is not None:
-                            found.append({"location": loc_name, "temp_type": elem_name, "temperature": temp_val})
-            for v in obj.values(): scan(v, loc_name)
+            for k in _LOC_KEYS:
+                name = obj.get(k)
+                if type(name) is str:
+                    loc_name = name; break
+            children = []
+            for k, v in obj.items():
+                if k == "weatherElement" and isinstance(v, list):
+                    for elem in v:
+                        if not isinstance(elem, dict): continue
+                        elem_name = elem.get("elementName") or elem.get("name") or ""
+                        if is_temp_name(elem_name):
+                            temp_val = None
+                            val_container = elem.get("elementValue") or elem.get("value")
+                            if isinstance(val_container, dict):
+                                temp_val = val_container.get("value") or val_container.get("measure")
+                            elif val_container is not None:
+                                temp_val = str(val_container)
+                            if loc_name and temp_val is not None:
+                                found.append({"location": loc_name, "temp_type": elem_name, "temperature": temp_val})
+                elif isinstance(v, (dict, list)):
+                    children.append((v, loc_name))
+            stack.extend(reversed(children))
         elif isinstance(obj, list):
-            for it in obj: scan(it, inherited_loc_name)
-    scan(data)
+            stack.extend((it, loc_name) for it in reversed(obj) if isinstance(it, (dict, list)))
     return found
 
-def write_sqlite(rows: List[Dict[str, Optional[str]]], db_path: str) -> None:
-    """Writes extracted temperature data to the SQLite database."""
-    if not rows: return
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS temperatures (id INTEGER PRIMARY KEY, location TEXT NOT NULL, temp_type TEXT NOT NULL, temperature REAL NOT NULL)")
-    cur.execute("DELETE FROM temperatures")
+def write_sqlite(rows: List[Dict[str, Optional[str]]], db_path: str) -> int:
+    """Writes extracted temperature data to the SQLite database in one transaction; returns the number of rows inserted."""
+    if not rows: return 0
+    payload = []
     for r in rows:
         loc, temp_type, temp = r.get("location"), r.get("temp_type"), r.get("temperature")
         if loc and temp_type and temp is not None:
             try:
-                cur.execute("INSERT INTO temperatures (location, temp_type, temperature) VALUES (?, ?, ?)", (loc, temp_type, float(temp)))
+                payload.append((loc, temp_type, float(temp)))
             except (ValueError, TypeError):
-                st.warning(f"Could not convert temperature '{temp}' to float for {loc}. Skipping.")
-    conn.commit()
+                pass
+    conn = sqlite3.connect(db_path)
+    for pragma in ("journal_mode=WAL", "synchronous=OFF", "temp_store=MEMORY", "cache_size=-100000"):
+        conn.execute(f"PRAGMA {pragma}")
+    # (location, temp_type) is the primary key; keep the last reading per pair, as INSERT OR REPLACE does.
+    payload = list({p[:2]: p for p in payload}.values())
+    conn.executescript(
+        "BEGIN; DROP TABLE IF EXISTS temperatures; "
+        "CREATE TABLE temperatures (seq INTEGER NOT NULL, location TEXT NOT NULL, temp_type TEXT NOT NULL, "
+        "temperature REAL NOT NULL, PRIMARY KEY (location, temp_type)) WITHOUT ROWID;")
+    # seq keeps document order, which a WITHOUT ROWID table would otherwise replace with key order.
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO temperatures (seq, location, temp_type, temperature) VALUES (?, ?, ?, ?)",
+                         ((i, *p) for i, p in enumerate(payload)))
     conn.close()
+    # Parquet preserves row order, so the payload order matches the DB's seq order.
+    pd.DataFrame(payload, columns=["location", "temp_type", "temperature"]).to_parquet(
+        os.path.splitext(db_path)[0] + ".parquet", compression="zstd", index=False)
+    return len(payload)
 
 def update_database_from_json(json_path: str = JSON_SOURCE, db_path: str = DB_FILE) -> str:
     """Reads the source JSON, processes it, and updates the SQLite DB."""
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(json_path, 'rb') as f:
+            data = orjson.loads(f.read())
         
         locations = find_locations(data.get('cwaopendata', data))
         if not locations:
             return "No locations/temperatures discovered in the JSON file."
             
-        write_sqlite(locations, db_path)
-        return f"Successfully updated database with {len(locations)} records."
+        written = write_sqlite(locations, db_path)
+        message = f"Successfully updated database with {written} records."
+        if written < len(locations):
+            message += f" Skipped {len(locations) - written} incomplete, non-numeric or duplicate records."
+        return message
     except FileNotFoundError:
         return f"Error: Source data file not found at `{json_path}`."
     except Exception as e:
         return f"An error occurred: {e}"
 
 # --- Data Loading for the App ---
-@st.cache_data
-def get_data() -> pd.DataFrame:
-    """Connects to the SQLite DB and returns a 'long' DataFrame with coordinates."""
-    if not os.path.exists(DB_FILE):
-        return pd.DataFrame()
+def _db_is_current(db_path: str = DB_FILE) -> bool:
+    """True when the DB exists with the current schema; databases written before the `seq` column must be rebuilt."""
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        df = pd.read_sql_query("SELECT location, temp_type, temperature FROM temperatures", conn)
-        coord_df = pd.DataFrame.from_dict(LOCATION_COORDS, orient='index').reset_index().rename(columns={'index': 'location'})
-        return pd.merge(df, coord_df, on='location')
+        return "seq" in {row[1] for row in conn.execute("PRAGMA table_info(temperatures)")}
     finally:
-        if 'conn' in locals() and conn:
-            conn.close()
+        conn.close()
+
+def _use_parquet() -> bool:
+    """True when the Parquet copy exists and is at least as new as the DB (the CLI only writes the DB)."""
+    return os.path.exists(PARQUET_FILE) and (
+        not os.path.exists(DB_FILE) or os.path.getmtime(PARQUET_FILE) >= os.path.getmtime(DB_FILE))
+
+def data_mtime() -> float:
+    """Returns the mtime of the file get_data_cached reads from, used as its cache key."""
+    if _use_parquet():
+        return os.path.getmtime(PARQUET_FILE)
+    return os.path.getmtime(DB_FILE) if os.path.exists(DB_FILE) else 0.0
+
+@st.cache_resource(max_entries=1)
+def get_data_cached(source_mtime: float) -> pd.DataFrame:
+    """
+    Loads the Parquet copy (or the SQLite DB) and returns a 'long' DataFrame with coordinates.
+    Cached as a shared resource keyed on the source mtime, so the frame is never copied or hashed; treat it as read-only.
+    """
+    if _use_parquet():
+        df = pd.read_parquet(PARQUET_FILE, dtype_backend="pyarrow")
+    elif not os.path.exists(DB_FILE):
+        return pd.DataFrame()
+    else:
+        try:
+            conn = sqlite3.connect(DB_FILE)
+            cur = conn.execute("SELECT location, temp_type, temperature FROM temperatures ORDER BY seq")
+            df = pd.DataFrame.from_records(cur.fetchall(), columns=[c[0] for c in cur.description])
+        finally:
+            if 'conn' in locals() and conn:
+                conn.close()
+    loc_idx = df["location"].map(_IDX)
+    known = loc_idx.notna().to_numpy()
+    df = df[known].copy()
+    loc_idx = loc_idx[known].to_numpy(dtype=np.intp)
+    df["lat"] = _LATS[loc_idx]
+    df["lon"] = _LONS[loc_idx]
+    return df
+
+@st.cache_data(max_entries=1)
+def get_pivoted(source_mtime: float) -> pd.DataFrame:
+    """Returns the wide location x temp_type table, keyed on the data file's mtime."""
+    return get_data_cached(source_mtime).pivot(index='location', columns='temp_type', values='temperature').reset_index()
+
+@st.cache_data(max_entries=1)
+def _by_location(source_mtime: float) -> Dict[str, List[Tuple[str, float]]]:
+    """Returns (temp_type, temperature) pairs per location, grouped once per data file version."""
+    df = get_data_cached(source_mtime)
+    return {loc: list(g[["temp_type", "temperature"]].itertuples(index=False, name=None))
+            for loc, g in df.groupby("location", sort=False)}
+
+@st.cache_data(max_entries=1)
+def _locations_index(source_mtime: float) -> Tuple[List[str], Dict[str, int]]:
+    """Returns the selectbox options and a name -> option index mapping, keyed on the data file's mtime."""
+    locs = ["All Locations"] + sorted(get_data_cached(source_mtime)["location"].unique())
+    return locs, {name: i for i, name in enumerate(locs)}
+
+def _build_map(selected: str, locs_key: tuple) -> folium.Map:
+    """Builds a fresh Folium map centred on the selection, with markers for the locations in `locs_key`."""
+    if selected == "All Locations":
+        map_center = [23.97, 120.96]; map_zoom = 7
+    elif (i := _IDX.get(selected)) is not None:
+        map_center = [float(_LATS[i]), float(_LONS[i])]; map_zoom = 10
+    else:
+        map_center = [23.97, 120.96]; map_zoom = 10
+
+    m = folium.Map(location=map_center, zoom_start=map_zoom, tiles="CartoDB positron")
+    layer = folium.FeatureGroup(name="stations")
+    for name, lat, lon in _MARKERS:
+        if name in locs_key:
+            popup = folium.Popup(name, parse_html=False, max_width=180)
+            layer.add_child(folium.Marker(location=[lat, lon], popup=popup, tooltip=name))
+    m.add_child(layer)
+    return m
 
 # --- Main App ---
 st.set_page_config(page_title="Taiwan Temperature Map", layout="wide")
 st.title("🌡️ Taiwan Temperature Viewer")
 
 # --- Initial Data Check and Setup ---
-if not os.path.exists(DB_FILE):
-    st.info(f"`{DB_FILE}` not found. Attempting to create it from `{JSON_SOURCE}`...")
+if not _db_is_current():
+    st.info(f"`{DB_FILE}` is missing or out of date. Attempting to (re)create it from `{JSON_SOURCE}`...")
     with st.spinner("Processing source data..."):
         result_message = update_database_from_json()
         st.success(result_message)
+        if not _db_is_current():
+            st.stop()
         st.rerun()
 
 # --- Initialize Session State ---
@@ -128,58 +235,49 @@ if 'selected_location' not in st.session_state:
     st.session_state.selected_location = "All Locations"
 
 # --- Load Data ---
-df = get_data()
+source_mtime = data_mtime()
+df = get_data_cached(source_mtime)
 
 if df.empty:
     st.warning(f"No data to display. Check if `{JSON_SOURCE}` exists and is valid.", icon="⚠️")
 else:
     # --- Sidebar and Map Controllers ---
     st.sidebar.header("📍 Location Selector")
-    locations_list = ["All Locations"] + sorted(df["location"].unique().tolist())
+    locations_list, location_index = _locations_index(source_mtime)
     
     # Logic for two-way sync between map and selectbox
     # 1. Create map and check for clicks
-    if st.session_state.selected_location == "All Locations":
-        map_center = [23.97, 120.96]; map_zoom = 7
-    else:
-        loc_info = LOCATION_COORDS.get(st.session_state.selected_location, {"lat": 23.97, "lon": 120.96})
-        map_center = [loc_info['lat'], loc_info['lon']]; map_zoom = 10
-
-    m = folium.Map(location=map_center, zoom_start=map_zoom, tiles="CartoDB positron")
-    for _, row in df.drop_duplicates('location').iterrows():
-        folium.Marker(location=[row['lat'], row['lon']], popup=row['location'], tooltip=row['location']).add_to(m)
-    
+    m = _build_map(st.session_state.selected_location, tuple(locations_list[1:]))
     map_data = st_folium(m, width='100%', height=400, key="folium_map")
 
-    # If map is clicked, update state and rerun
-    if map_data and map_data.get("last_object_clicked_popup"):
-        clicked_loc = map_data["last_object_clicked_popup"]
-        if st.session_state.selected_location != clicked_loc:
-            st.session_state.selected_location = clicked_loc
-            st.rerun()
-
-    # 2. Create selectbox and check for changes
-    current_selection_index = locations_list.index(st.session_state.selected_location)
+    # 2. Create selectbox
+    current_selection_index = location_index[st.session_state.selected_location]
     selection = st.sidebar.selectbox("Choose a location:", locations_list, index=current_selection_index)
 
-    if st.session_state.selected_location != selection:
-        st.session_state.selected_location = selection
+    # 3. Resolve both widgets into one selection and rerun at most once.
+    # st_folium keeps returning the last click, so only a click that differs from the previous one counts.
+    clicked_loc = map_data.get("last_object_clicked_popup") if map_data else None
+    new_click = clicked_loc if clicked_loc != st.session_state.get("last_map_click") and clicked_loc in location_index else None
+    st.session_state.last_map_click = clicked_loc
+    new_selection = new_click or selection
+    if new_selection != st.session_state.selected_location:
+        st.session_state.selected_location = new_selection
         st.rerun()
 
     # --- Display Data ---
     st.write("---")
     if st.session_state.selected_location == "All Locations":
         st.header("📊 Full Data Overview")
-        pivoted_df = df.pivot_table(index='location', columns='temp_type', values='temperature').reset_index()
+        pivoted_df = get_pivoted(source_mtime)
         st.dataframe(pivoted_df, use_container_width=True, hide_index=True)
     else:
         st.header(f"🌡️ Temperature Details for {st.session_state.selected_location}")
-        location_data_long = df[df['location'] == st.session_state.selected_location]
-        
-        cols = st.columns(len(location_data_long))
-        for i, row in enumerate(location_data_long.itertuples()):
-            with cols[i]:
-                st.metric(label=row.temp_type, value=f"{row.temperature} °C")
+        readings = _by_location(source_mtime)[st.session_state.selected_location]
+
+        cols = st.columns(len(readings))
+        for col, (temp_type, temperature) in zip(cols, readings):
+            with col:
+                st.metric(label=temp_type, value=f"{temperature} °C")
 
     # --- Actions ---
     st.sidebar.write("---")
@@ -188,7 +286,7 @@ else:
         with st.spinner("Fetching latest data from source..."):
             update_message = update_database_from_json()
             st.sidebar.success(update_message)
-            st.cache_data.clear() # Clear cache to force data reload
+            get_data_cached.clear() # Clear cache to force data reload
         st.rerun()
 
     st.sidebar.write("---")
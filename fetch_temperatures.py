@@ -8,112 +8,156 @@ Usage examples (Windows cmd):
 """
 import argparse
 import csv
-import json
-import re
+import os
 import sqlite3
 import sys
-from typing import Any, Dict, List, Optional
+from collections import deque
+from typing import Any, BinaryIO, Dict, List, Optional
+
+import ijson
+import orjson
+
+
+# Substrings marking a temperature element ("temp" also covers "temperature").
+_TEMP_TOKENS = ("temp", "溫度")
+# Files larger than this are streamed location by location instead of loaded whole.
+STREAM_THRESHOLD = 32 * 1024 * 1024
+# Most common CWA key first; interned so key comparisons are pointer checks.
+_LOC_KEYS = tuple(sys.intern(k) for k in ("locationName", "stationName", "siteName", "location", "locationname", "name"))
 
 
 def is_temp_name(name: str) -> bool:
     """Checks if an element name looks like a temperature."""
-    return bool(re.search(r"temp|temperature|t\b|溫度", name, re.IGNORECASE))
+    n = name.lower()
+    # A word ending in "t" covers CWA forecast names such as T, AT, MaxT and MinT (the old t\b case).
+    return any(t in n for t in _TEMP_TOKENS) or any(w.endswith("t") for w in n.split())
 
 
 def find_locations(data: Any) -> List[Dict[str, Optional[str]]]:
     """
-    Recursively scan JSON to find objects that represent locations with temperatures.
+    Scan JSON to find objects that represent locations with temperatures.
     Returns list of dicts with keys: 'location', 'temp_type', and 'temperature'.
     """
     found: List[Dict[str, Optional[str]]] = []
+    # Explicit stack of (obj, inherited location name) instead of recursion.
+    stack = deque([(data, None)])
 
-    def scan(obj: Any, inherited_loc_name: Optional[str] = None):
+    while stack:
+        obj, loc_name = stack.pop()
         if isinstance(obj, dict):
             # Try to find a location name in the current object, otherwise use the one passed down.
-            loc_name = inherited_loc_name
-            for k in ("locationName", "locationname", "location", "siteName", "stationName", "name"):
-                if k in obj and isinstance(obj[k], str):
-                    loc_name = obj[k]
+            for k in _LOC_KEYS:
+                name = obj.get(k)
+                if type(name) is str:
+                    loc_name = name
                     break
 
-            # Check for weather elements in the current object
-            if "weatherElement" in obj and isinstance(obj["weatherElement"], list):
-                for elem in obj["weatherElement"]:
-                    if not isinstance(elem, dict):
-                        continue
-                    
-                    elem_name = elem.get("elementName") or elem.get("name") or ""
-                    
-                    if is_temp_name(elem_name):
-                        temp_val = None
-                        val_container = elem.get("elementValue") or elem.get("value")
-                        if isinstance(val_container, dict):
-                            temp_val = val_container.get("value") or val_container.get("measure")
-                        elif val_container is not None:
-                            temp_val = str(val_container)
-
-                        if loc_name and temp_val is not None:
-                            found.append({
-                                "location": loc_name,
-                                "temp_type": elem_name,
-                                "temperature": temp_val
-                            })
-
-            # Continue recursion, passing down the most recently found location name
-            for v in obj.values():
-                scan(v, loc_name)
+            children = []
+            for k, v in obj.items():
+                if k == "weatherElement" and isinstance(v, list):
+                    # Extract temperatures here; the list is not scanned again as a generic value.
+                    for elem in v:
+                        if not isinstance(elem, dict):
+                            continue
+
+                        elem_name = elem.get("elementName") or elem.get("name") or ""
+
+                        if is_temp_name(elem_name):
+                            temp_val = None
+                            val_container = elem.get("elementValue") or elem.get("value")
+                            if isinstance(val_container, dict):
+                                temp_val = val_container.get("value") or val_container.get("measure")
+                            elif val_container is not None:
+                                temp_val = str(val_container)
+
+                            if loc_name and temp_val is not None:
+                                found.append({
+                                    "location": loc_name,
+                                    "temp_type": elem_name,
+                                    "temperature": temp_val
+                                })
+                elif isinstance(v, (dict, list)):
+                    # Pass down the most recently found location name; scalars have nothing to scan
+                    children.append((v, loc_name))
+            # Push in reverse so items are visited in document order.
+            stack.extend(reversed(children))
 
         elif isinstance(obj, list):
             # For lists, pass down the same inherited location name to each item
-            for it in obj:
-                scan(it, inherited_loc_name)
+            stack.extend((it, loc_name) for it in reversed(obj) if isinstance(it, (dict, list)))
 
-    scan(data)
     # No de-duplication needed as we now want all temperature types.
     return found
 
 
+def stream_locations(f: BinaryIO) -> List[Dict[str, Optional[str]]]:
+    """
+    Stream the location records of a CWA file one at a time and extract their temperatures.
+    Peak memory is bounded by the largest single location rather than the whole file.
+    """
+    found: List[Dict[str, Optional[str]]] = []
+    for loc in ijson.items(f, "cwaopendata.dataset.location.item"):
+        found.extend(find_locations(loc))
+    return found
+
+
 def write_csv(rows: List[Dict[str, Optional[str]]], out_path: str) -> None:
     if not rows:
         return
-    with open(out_path, "w", newline='', encoding='utf-8') as f:
+    with open(out_path, "w", newline='', encoding='utf-8', buffering=1 << 20) as f:
         writer = csv.writer(f)
         writer.writerow(["location", "temp_type", "temperature"])
-        for r in rows:
-            writer.writerow([r.get("location"), r.get("temp_type"), r.get("temperature")])
+        writer.writerows((r.get("location"), r.get("temp_type"), r.get("temperature")) for r in rows)
 
 
-def write_sqlite(rows: List[Dict[str, Optional[str]]], db_path: str) -> None:
+def write_sqlite(rows: List[Dict[str, Optional[str]]], db_path: str) -> int:
+    """Writes rows in a single transaction and returns how many were inserted."""
     if not rows:
-        return
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS temperatures (
-            id INTEGER PRIMARY KEY,
-            location TEXT NOT NULL,
-            temp_type TEXT NOT NULL,
-            temperature REAL NOT NULL
-        )
-    """)
-    # Clear the table before inserting new data
-    cur.execute("DELETE FROM temperatures")
-    
+        return 0
+
+    payload = []
+    skipped = 0
     for r in rows:
         loc = r.get("location")
         temp_type = r.get("temp_type")
         temp = r.get("temperature")
         if loc and temp_type and temp is not None:
             try:
-                temp_float = float(temp)
-                cur.execute("INSERT INTO temperatures (location, temp_type, temperature) VALUES (?, ?, ?)", 
-                            (loc, temp_type, temp_float))
+                payload.append((loc, temp_type, float(temp)))
             except (ValueError, TypeError):
-                print(f"Warning: Could not convert temperature '{temp}' to float. Skipping.", file=sys.stderr)
+                skipped += 1
+
+    # (location, temp_type) is the primary key; keep the last reading per pair at the pair's first position.
+    payload = list({p[:2]: p for p in payload}.values())
 
-    conn.commit()
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-100000")
+    # Full replace on every run: recreate the table keyed on (location, temp_type) without a rowid.
+    # seq records document order, since a WITHOUT ROWID table is stored in key order.
+    conn.executescript("""
+        BEGIN;
+        DROP TABLE IF EXISTS temperatures;
+        CREATE TABLE temperatures (
+            seq INTEGER NOT NULL,
+            location TEXT NOT NULL,
+            temp_type TEXT NOT NULL,
+            temperature REAL NOT NULL,
+            PRIMARY KEY (location, temp_type)
+        ) WITHOUT ROWID;
+    """)
+    # Insert the new data in the transaction opened above
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO temperatures (seq, location, temp_type, temperature) VALUES (?, ?, ?, ?)",
+                         ((i, *p) for i, p in enumerate(payload)))
     conn.close()
 
+    if skipped:
+        print(f"Warning: Skipped {skipped} rows whose temperature could not be converted to float.", file=sys.stderr)
+    return len(payload)
+
 
 def main(argv: Optional[List[str]] = None) -> int:
     parser = argparse.ArgumentParser(description="Parse temperatures from a CWA open data JSON file")
@@ -125,17 +169,22 @@ def main(argv: Optional[List[str]] = None) -> int:
 
     print(f"Reading: {args.file}")
     try:
-        with open(args.file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(args.file, 'rb') as f:
+            locations = stream_locations(f) if os.path.getsize(args.file) > STREAM_THRESHOLD else []
+            if not locations:
+                # Small file, or a large one without the cwaopendata.dataset.location layout:
+                # fall back to a full parse and the generic scan.
+                f.seek(0)
+                data = orjson.loads(f.read())
+                # The actual data is nested inside the 'cwaopendata' key.
+                locations = find_locations(data.get('cwaopendata', data))
     except FileNotFoundError:
         print(f"Error: Input file not found at {args.file}")
         return 2
-    except (json.JSONDecodeError, Exception) as e:
+    except Exception as e:
         print(f"Failed to read or parse file: {e}")
         return 3
 
-    # The actual data is nested inside the 'cwaopendata' key.
-    locations = find_locations(data.get('cwaopendata', data))
     if not locations:
         print("No locations/temperatures discovered.")
         return 4
@@ -147,8 +196,8 @@ def main(argv: Optional[List[str]] = None) -> int:
 
     # Write to SQLite
     if args.db:
-        write_sqlite(locations, args.db)
-        print(f"Wrote {len(locations)} rows to SQLite database: {args.db}")
+        written = write_sqlite(locations, args.db)
+        print(f"Wrote {written} rows to SQLite database: {args.db}")
 
     print("\nSample of extracted data:")
     for r in locations[: args.sample]: